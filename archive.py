@@ -0,0 +1,106 @@
+"""Archive a finished run and export it, archived rows included.
+
+Archiving is never done by the experiment itself. Once recruitment has
+closed and every participant has been checked and paid, run
+
+    python archive.py archive
+
+to move the rows of the full networks out of the hot tables, and
+
+    python archive.py export <directory>
+
+to write every table to a CSV file, reading archived and hot rows alike.
+"""
+
+from __future__ import print_function
+from wallace import db
+from psiturk.models import Participant
+from sqlalchemy import Table, Column
+from sqlalchemy.sql.expression import select, union_all
+import argparse
+import csv
+import os
+import sys
+
+# Once a network is full its rows are read-only, so they can be moved out of
+# the hot tables that live requests query. These are the tables whose rows
+# belong to a single network, parents before children.
+archived_tables = ["node", "vector", "info", "transmission", "transformation"]
+
+
+def archive_table(name):
+    """The archive table that mirrors a hot table, with no foreign keys."""
+    archive_name = "archive_" + name
+    if archive_name not in db.Base.metadata.tables:
+        hot = db.Base.metadata.tables[name]
+        Table(
+            archive_name, db.Base.metadata,
+            *[Column(c.name, c.type.copy(), primary_key=c.primary_key,
+                     index=(c.name == "network_id"))
+              for c in hot.columns])
+    return db.Base.metadata.tables[archive_name]
+
+for table_name in archived_tables:
+    archive_table(table_name)
+
+
+def with_archive(name):
+    """Select all the rows of a table, whether they are hot or archived."""
+    hot = db.Base.metadata.tables[name]
+    archive = archive_table(name)
+    return union_all(
+        select([hot]),
+        select([archive.c[c.name] for c in hot.columns])).alias(name)
+
+
+# Participants who have submitted have status 100 until their data,
+# attention check and bonus have been worked out from the hot tables, so
+# they are waited for too.
+def archive(exp):
+    """Archive every full network of exp, if no-one is still taking part."""
+    if exp.networks(full=False):
+        raise ValueError("Some networks are not full yet.")
+    if Participant.query.filter(Participant.status <= 100).count():
+        raise ValueError("Some participants are still taking part or being checked.")
+    return exp.archive_networks()
+
+
+def export(directory):
+    """Write each table to directory/<table>.csv, archived rows included."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name, table in sorted(db.Base.metadata.tables.items()):
+        if name.startswith("archive_"):
+            continue
+        if name in archived_tables:
+            table = with_archive(name)
+        query = select([table])
+        if "id" in table.c:
+            query = query.order_by(table.c.id)
+        rows = db.session.execute(query)
+        with open(os.path.join(directory, name + ".csv"), "w") as f:
+            writer = csv.writer(f)
+            writer.writerow([c.name for c in table.columns])
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive or export a Rogers run.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    commands.add_parser("archive", help="move the rows of the full networks into the archive tables")
+    export_parser = commands.add_parser("export", help="write every table to CSV, archived rows included")
+    export_parser.add_argument("directory", help="where to write the CSV files")
+    args = parser.parse_args()
+
+    if args.command == "archive":
+        from experiment import RogersExperiment2b
+        try:
+            archived = archive(RogersExperiment2b(db.get_session()))
+        except ValueError as e:
+            print("Not archiving: {}".format(e))
+            sys.exit(1)
+        print("Archived {} networks.".format(len(archived)))
+    else:
+        export(args.directory)
+        print("Exported to {}".format(args.directory))
@@ -0,0 +1,166 @@
+"""Build fingerprinted, precompressed bundles of the static files.
+
+Run this before deploying. The bundles are written to static/build and
+served by the /assets route in experiment.py, which picks the brotli or
+gzip copy the browser accepts. Without a build the pages load the
+original static files, which is only allowed in debug mode: in any other
+mode the server refuses to start.
+"""
+
+from __future__ import print_function
+from json import dump, load
+import gzip
+import hashlib
+import io
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+build_dir = os.path.join(here, "static", "build")
+
+# files are bundled in the order exp.html used to load them
+bundles = [
+    ("lib.js", [
+        "static/lib/jquery-min.js",
+        "static/lib/underscore-min.js",
+        "static/lib/backbone-min.js",
+        "static/lib/d3.v3.min.js",
+        "static/lib/reqwest.min.js",
+        "static/lib/markdown.min.js",
+        "static/lib/raphael-min.js",
+        "static/lib/amplify.min.js",
+        "static/js/utils.js"]),
+    ("task.js", ["static/js/task.js"]),
+    ("style.css", ["static/css/bootstrap.min.css", "static/css/style.css"]),
+]
+fonts = [
+    "static/fonts/glyphicons-halflings-regular.eot",
+    "static/fonts/glyphicons-halflings-regular.svg",
+    "static/fonts/glyphicons-halflings-regular.ttf",
+    "static/fonts/glyphicons-halflings-regular.woff",
+]
+compressible = [".js", ".css", ".svg", ".eot", ".ttf"]
+encodings = [("br", ".br"), ("gzip", ".gz")]
+
+
+def read(path):
+    with open(os.path.join(here, path), "rb") as f:
+        return f.read()
+
+
+def fingerprinted(name, contents):
+    """name with a hash of contents before its extension."""
+    base, extension = os.path.splitext(name)
+    return "{}.{}{}".format(base, hashlib.md5(contents).hexdigest()[:12], extension)
+
+
+def write(directory, name, contents):
+    """Write a file into the build, with gzip and brotli copies."""
+    with open(os.path.join(directory, name), "wb") as f:
+        f.write(contents)
+    if os.path.splitext(name)[1] not in compressible:
+        return
+    compressed = io.BytesIO()
+    with gzip.GzipFile(filename="", mode="wb", compresslevel=9, fileobj=compressed, mtime=0) as f:
+        f.write(contents)
+    with open(os.path.join(directory, name + ".gz"), "wb") as f:
+        f.write(compressed.getvalue())
+    if brotli is not None:
+        with open(os.path.join(directory, name + ".br"), "wb") as f:
+            f.write(brotli.compress(contents))
+
+
+def build(directory=build_dir):
+    """Rebuild the build directory and return its manifest.
+
+    The manifest maps each bundle and font to its fingerprinted name.
+    """
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    manifest = {}
+
+    for path in fonts:
+        contents = read(path)
+        name = fingerprinted(os.path.basename(path), contents)
+        write(directory, name, contents)
+        manifest[os.path.basename(path)] = name
+
+    for name, paths in bundles:
+        if name.endswith(".css"):
+            # the css is served from the same place as the fonts now
+            contents = re.sub(
+                b"\\.\\./fonts/([\\w.-]+)",
+                lambda m: manifest[m.group(1).decode("utf-8")].encode("utf-8"),
+                b"\n".join(read(path) for path in paths))
+        else:
+            contents = b";\n".join(read(path) for path in paths)
+        fingerprinted_name = fingerprinted(name, contents)
+        write(directory, fingerprinted_name, contents)
+        manifest[name] = fingerprinted_name
+
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        dump(manifest, f, indent=4, sort_keys=True)
+    return manifest
+
+
+def load_manifest(directory=build_dir):
+    """The manifest of the build in directory, or {} if there is no build."""
+    try:
+        with open(os.path.join(directory, "manifest.json")) as f:
+            return load(f)
+    except IOError:
+        return {}
+
+
+# The build the server was started with. Its names include a hash of their
+# contents, so they can be cached for as long as browsers allow.
+manifest = load_manifest()
+
+
+def encoding_qualities(header):
+    """The quality of each encoding named in an Accept-Encoding header."""
+    qualities = {}
+    for part in header.split(","):
+        params = part.split(";")
+        name = params[0].strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+    return qualities
+
+
+def encoded_file(directory, filename, accept_encoding):
+    """The path and encoding of the copy of a built file the browser prefers."""
+    qualities = encoding_qualities(accept_encoding)
+    path = os.path.join(directory, filename)
+    encoding = None
+    best = 0
+    for name, extension in encodings:
+        quality = qualities.get(name, qualities.get("*", 0))
+        if quality > best and os.path.exists(os.path.join(directory, filename + extension)):
+            path = os.path.join(directory, filename + extension)
+            encoding = name
+            best = quality
+    return path, encoding
+
+
+if __name__ == "__main__":
+    for name, fingerprinted_name in sorted(build().items()):
+        print("{} -> static/build/{}".format(name, fingerprinted_name))
+    if brotli is None:
+        print("brotli is not installed: only gzip copies were made.")
@@ -0,0 +1,257 @@
+"""Time the experiment's hooks, and fail if any of them has slowed down.
+
+Each hook is timed in a seeded run at several sizes of database: just
+after setup, and after 10 and 39 generations. The databases are simulated
+once and kept as checkpoints in .benchmarks, so later runs only restore
+them. Every timed call is made inside a transaction that is rolled back
+afterwards, so the database is the same for each repeat.
+
+The benchmarks run in an in-memory SQLite database unless another is
+given with --database or SIMULATION_DATABASE_URL. Each backend keeps its
+own checkpoints and baselines. Checkpoints are also kept apart by a hash
+of the schema and of the code that simulates them, so a change to either
+simulates them again. The baselines are kept in benchmarks.json.
+A hook has regressed if its median time is more than threshold times its
+baseline, and a hook with no baseline fails too. Record new baselines with
+--update after a deliberate change, on the machine that runs the check.
+"""
+
+from __future__ import print_function
+from wallace import db
+from wallace.information import Meme
+from psiturk.models import Participant
+from experiment import RogersExperiment2b, RogersSocialSource
+from contextlib import contextmanager
+from json import dump, load
+from operator import attrgetter
+from timeit import default_timer
+import argparse
+import hashlib
+import os
+import sys
+import simulation
+
+here = os.path.dirname(os.path.abspath(__file__))
+baselines_path = os.path.join(here, "benchmarks.json")
+checkpoint_dir = os.path.join(here, ".benchmarks")
+generations = [0, 10, 39]
+seed = 1
+# the modules whose code decides what a simulated run writes
+simulated_by = ["experiment.py", "simulation.py", "randomness.py", "stats.py", "transactions.py", "archive.py"]
+participant_id = "benchmark:benchmark"
+
+
+@contextmanager
+def rolled_back():
+    """A session whose changes are all rolled back when it is done with.
+
+    The session is joined to an outer transaction on its own connection,
+    so the commits made by the hooks only end a subtransaction.
+    """
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    db.session.remove()
+    db.session.configure(bind=connection)
+    try:
+        yield db.session
+    finally:
+        db.session.remove()
+        transaction.rollback()
+        connection.close()
+        db.session.configure(bind=db.engine)
+
+
+def experiment(session):
+    exp = RogersExperiment2b(session)
+    exp.verbose = False
+    return exp
+
+
+def experiment_network(exp, kind="single_agent"):
+    """The first experiment network with a social source of kind."""
+    ids = [s.network_id for s in RogersSocialSource.query.filter_by(kind=kind).all()]
+    return sorted([net for net in exp.networks(role="experiment") if net.id in ids], key=attrgetter("id"))[0]
+
+
+def new_agent(exp, network):
+    """A new agent, added to network as if by the /node route."""
+    node = exp.create_node(participant_id=participant_id, network=network)
+    exp.add_node_to_network(participant_id=participant_id, node=node, network=network)
+    exp.save()
+    return node
+
+
+# Each benchmark does any preparation it needs and returns the call to time,
+# or None if the hook has nothing to do at this size of database.
+
+def setup_benchmark(session):
+    return lambda: experiment(session)
+
+
+def add_node_benchmark(session):
+    exp = experiment(session)
+    network = experiment_network(exp)
+    node = exp.create_node(participant_id=participant_id, network=network)
+    return lambda: exp.add_node_to_network(participant_id=participant_id, node=node, network=network)
+
+
+def info_post_benchmark(session):
+    exp = experiment(session)
+    node = new_agent(exp, experiment_network(exp))
+    node.receive()
+    exp.save()
+    info = Meme(origin=node, contents="blue")
+    return lambda: exp.info_post_request(node=node, info=info)
+
+
+def what_benchmark(kind):
+    def benchmark(session):
+        exp = experiment(session)
+        network = experiment_network(exp, kind)
+        node = new_agent(exp, network)
+        if node.generation == 0:
+            return None
+        social_source = network.nodes(type=RogersSocialSource)[0]
+        return lambda: social_source._what(agent=node)
+    return benchmark
+
+
+def submission_benchmark(session):
+    exp = experiment(session)
+    participant = Participant(workerid="benchmark", assignmentid="benchmark", hitid="benchmark", mode="debug")
+    return lambda: exp.submission_successful(participant=participant)
+
+
+def bonus_benchmark(session):
+    exp = experiment(session)
+    participant = Participant.query.filter_by(status=101).first()
+    if participant is None:
+        return None
+    return lambda: exp.bonus(participant=participant)
+
+
+benchmarks = [
+    ("add_node_to_network", add_node_benchmark),
+    ("info_post_request", info_post_benchmark),
+    ("_what single_agent", what_benchmark("single_agent")),
+    ("_what single_generation", what_benchmark("single_generation")),
+    ("_what triple_generation", what_benchmark("triple_generation")),
+    ("submission_successful", submission_benchmark),
+    ("bonus", bonus_benchmark),
+]
+
+
+def median_time(benchmark, repeat):
+    """The median time of the call benchmark returns, in seconds."""
+    times = []
+    for _ in range(repeat):
+        with rolled_back() as session:
+            call = benchmark(session)
+            if call is None:
+                return None
+            start = default_timer()
+            call()
+            times.append(default_timer() - start)
+    return sorted(times)[len(times)//2]
+
+
+def checkpoint_key():
+    """A hash of the schema and of the code the checkpoints were simulated with."""
+    key = hashlib.sha1(simulation.schema().encode("utf-8"))
+    for name in simulated_by:
+        with open(os.path.join(here, name), "rb") as f:
+            key.update(f.read())
+    return key.hexdigest()[:12]
+
+
+def restore(generation):
+    """Restore the checkpoint of the run after generation generations.
+
+    It is simulated from the largest earlier checkpoint, or from scratch,
+    the first time it is needed.
+    """
+    key = checkpoint_key()
+
+    def checkpoint(generation):
+        return os.path.join(checkpoint_dir, db.engine.dialect.name, key, "generation{}".format(generation))
+
+    path = checkpoint(generation)
+    if os.path.isdir(path):
+        simulation.load_checkpoint(path)
+        return
+
+    earlier = [g for g in generations if g < generation and os.path.isdir(checkpoint(g))]
+    if earlier:
+        session = simulation.load_checkpoint(checkpoint(max(earlier)))
+        exp = experiment(session)
+    else:
+        session = simulation.reset_database()
+        exp = RogersExperiment2b(session, seed=seed)
+        exp.verbose = False
+    print("Simulating generation {} checkpoint...".format(generation))
+    simulation.simulate(exp, participants=generation*exp.generation_size - simulation.completed_participants())
+    simulation.save_checkpoint(path)
+
+
+def run(sizes, repeat):
+    """Time every hook at each size. Returns a dict of median times."""
+    results = {}
+    simulation.reset_database()
+    results["setup"] = median_time(setup_benchmark, repeat)
+    for generation in sizes:
+        restore(generation)
+        for name, benchmark in benchmarks:
+            results["generation{}/{}".format(generation, name)] = median_time(benchmark, repeat)
+    return results
+
+
+def regressions(results, baselines, threshold):
+    """Print the results against the baselines and return the regressions.
+
+    Hooks with no baseline are counted as regressions.
+    """
+    slower = []
+    for name in sorted(results):
+        time = results[name]
+        if time is None:
+            print("{:<45} skipped".format(name))
+        elif name not in baselines:
+            print("{:<45} {:9.4f}s  no baseline".format(name, time))
+            slower.append(name)
+        else:
+            ratio = time/baselines[name]
+            print("{:<45} {:9.4f}s  baseline {:9.4f}s  {:+.0%}".format(name, time, baselines[name], ratio - 1))
+            if ratio > threshold:
+                slower.append(name)
+    return slower
+
+
+if __name__ == "__main__":
+    with open(baselines_path) as f:
+        config = load(f)
+
+    parser = argparse.ArgumentParser(description="Benchmark the Rogers experiment's hooks.")
+    parser.add_argument("--generations", type=int, nargs="+", default=generations, help="database sizes to time the hooks at")
+    parser.add_argument("--repeat", type=int, default=config["repeat"], help="times to call each hook")
+    parser.add_argument("--threshold", type=float, default=config["threshold"], help="slowdown that counts as a regression")
+    parser.add_argument("--update", action="store_true", help="save these times as the new baselines")
+    parser.add_argument("--database", metavar="URL", default=os.environ.get("SIMULATION_DATABASE_URL", "sqlite://"),
+                        help="run in this database, e.g. postgresql://localhost/wallace (default: sqlite:// in memory)")
+    args = parser.parse_args()
+
+    simulation.use_database(args.database)
+
+    baselines = config["baselines"].setdefault(db.engine.dialect.name, {})
+    results = run(sorted(args.generations), args.repeat)
+    slower = regressions(results, baselines, args.threshold)
+
+    if args.update:
+        baselines.update((name, time) for name, time in results.items() if time is not None)
+        with open(baselines_path, "w") as f:
+            dump(config, f, indent=4, sort_keys=True)
+        print("Baselines saved to {}".format(baselines_path))
+    elif slower:
+        print("{} hooks regressed by more than {:.0%} or have no baseline: {}".format(
+            len(slower), args.threshold - 1, ", ".join(slower)))
+        print("Run with --update to record baselines after a deliberate change.")
+        sys.exit(1)
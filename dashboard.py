@@ -0,0 +1,53 @@
+"""Stream the generation stats to the dashboard."""
+
+from wallace import db
+from psiturk.user_utils import PsiTurkAuthorization
+from sqlalchemy.orm import Session
+from json import dumps
+from functools import wraps
+from replica import replica_engine
+from settings import experiment_config
+from stats import generation_stats
+import time
+
+# Every dashboard stream in a process shares one snapshot of the stats,
+# refreshed at most once per dashboard_interval seconds, so the number of
+# people watching does not change the load on the database. Streams end
+# after dashboard_stream_length seconds and the browser reconnects.
+dashboard_interval = 1.0
+dashboard_stream_length = 300
+dashboard_snapshot = {"time": None, "data": None}
+
+
+def requires_login(view):
+    """Ask for the login in config.txt before running view."""
+    @wraps(view)
+    def logged_in_view(*args, **kwargs):
+        return PsiTurkAuthorization(experiment_config()).requires_auth(view)(*args, **kwargs)
+    return logged_in_view
+
+
+def dashboard_data():
+    """The latest generation stats, as JSON."""
+    now = time.time()
+    if dashboard_snapshot["time"] is None or now - dashboard_snapshot["time"] >= dashboard_interval:
+        session = Session(bind=replica_engine() or db.engine)
+        try:
+            dashboard_snapshot["data"] = dumps(generation_stats(session), separators=(',', ':'))
+        finally:
+            session.close()
+        dashboard_snapshot["time"] = now
+    return dashboard_snapshot["data"]
+
+
+def dashboard_events():
+    """Server-sent events with the stats, sent whenever they change."""
+    yield "retry: {}\n\n".format(int(dashboard_interval*1000))
+    stop = time.time() + dashboard_stream_length
+    last = None
+    while time.time() < stop:
+        data = dashboard_data()
+        if data != last:
+            yield "data: {}\n\n".format(data)
+            last = data
+        time.sleep(dashboard_interval)
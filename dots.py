@@ -0,0 +1,34 @@
+"""Layouts of the dots in the stimulus display."""
+
+import math
+import random
+
+# The stimulus display draws its dots from a pool of layouts made on the
+# server, so the browser has no placement work to do before showing them.
+dot_display = {"width": 600, "height": 400, "dots": 80, "min_radius": 10, "max_radius": 20}
+dot_layout_pool_size = 100
+dot_layout_pool = []
+dot_layout_rng = random.Random()
+
+
+def dot_layout(rng):
+    """Place non-overlapping dots in the display by rejection sampling, returning (x, y, r)s."""
+    dots = []
+    while len(dots) < dot_display["dots"]:
+        r = rng.randint(dot_display["min_radius"], dot_display["max_radius"])
+        x = rng.randint(r, dot_display["width"] - r)
+        y = rng.randint(r, dot_display["height"] - r)
+        if all((x - dx)**2 + (y - dy)**2 >= (r + dr)**2 for (dx, dy, dr) in dots):
+            dots.append((x, y, r))
+    return dots
+
+
+def colored_dot_layout(proportion):
+    """A layout from the pool as a flat list of x, y, radius and color (0 blue, 1 yellow)."""
+    while len(dot_layout_pool) < dot_layout_pool_size:
+        dot_layout_pool.append(dot_layout(dot_layout_rng))
+    dots = dot_layout_rng.choice(dot_layout_pool)
+    blue = int(math.floor(proportion*dot_display["dots"] + 0.5))
+    colors = [0]*blue + [1]*(dot_display["dots"] - blue)
+    dot_layout_rng.shuffle(colors)
+    return [v for (x, y, r), color in zip(dots, colors) for v in (x, y, r, color)]
@@ -6,19 +6,32 @@ from wallace.nodes import Source, Agent, Environment
 from wallace.networks import DiscreteGenerational
 from wallace.models import Node, Network, Info, Transmission
 from wallace import transformations
+from wallace import db
 from psiturk.models import Participant
 from sqlalchemy import Integer, Float
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.sql.expression import cast
-from sqlalchemy import and_
-from flask import Blueprint, request, Response
-from json import dumps
-import random
+from sqlalchemy.sql.expression import cast, select, bindparam
+from flask import Blueprint, request, Response, send_file, abort, g, stream_with_context
+from json import dumps, loads
+from archive import archived_tables, archive_table
+from dashboard import dashboard_events, requires_login
+from dots import colored_dot_layout
+from queries import baked_query
+from randomness import seed_rng, rng, network_rng
+from replica import read_session
+from settings import experiment_config
+from stats import GenerationStats, generation_stats_kinds, count_generation_stats
+from transactions import coalesced
+import assets
+import mimetypes
+import re
 
 
 class RogersExperiment2b(Experiment):
 
-    def __init__(self, session):
+    def __init__(self, session, seed=None):
+        if seed is not None:
+            seed_rng(seed)
         super(RogersExperiment2b, self).__init__(session)
 
         self.task = "Rogers network game"
@@ -31,13 +44,17 @@ class RogersExperiment2b(Experiment):
         self.social_source_kinds = ["single_agent", "single_generation", "triple_generation"]*(self.experiment_repeats + self.practice_repeats)
         self.catch_difficulty = 0.80
         self.min_acceptable_performance = 10/float(12)
+        self.generations = 40
         self.generation_size = 40
         self.network = lambda: DiscreteGenerational(
-            generations=40, generation_size=self.generation_size, initial_source=True)
+            generations=self.generations, generation_size=self.generation_size, initial_source=True)
         self.environment_type = RogersEnvironment
         self.bonus_payment = 1.0
         self.initial_recruitment_size = self.generation_size
         self.known_classes["LearningGene"] = LearningGene
+        # set to run add_node_to_network and info_post_request as one unit of
+        # work each, as simulations may (see unit_of_work)
+        self.coalesce_commits = False
 
         if not self.networks():
             self.setup()
@@ -46,7 +63,8 @@ class RogersExperiment2b(Experiment):
     def setup(self):
         super(RogersExperiment2b, self).setup()
 
-        for net in random.sample(self.networks(role="experiment"), self.catch_repeats):
+        experiment_networks = sorted(self.networks(role="experiment"), key=lambda net: net.id)
+        for net in rng().sample(experiment_networks, self.catch_repeats):
             net.role = "catch"
 
         for net in self.networks():
@@ -62,6 +80,11 @@ class RogersExperiment2b(Experiment):
                 difficulty = self.difficulties[self.networks(role="experiment").index(net)]
                 RogersEnvironment(proportion=difficulty, network=net)
 
+        network_kinds.clear()
+        for generation in range(self.generations):
+            for kind in generation_stats_kinds:
+                self.session.add(GenerationStats(generation=generation, kind=kind))
+
     def agent(self, network=None):
         if network.role == "practice" or network.role == "catch":
             return RogersAgentFounder
@@ -70,6 +93,7 @@ class RogersExperiment2b(Experiment):
         else:
             return RogersAgent
 
+    @coalesced
     def add_node_to_network(self, participant_id, node, network):
 
         key = participant_id[0:5]
@@ -81,7 +105,8 @@ class RogersExperiment2b(Experiment):
         node.generation = current_generation
         self.log("Agent is {}th agent in network, assigned to generation {}".format(num_agents, current_generation), key)
 
-        network.add_node(node)
+        with network_rng(network.id):
+            network.add_node(node)
 
         node.receive()
 
@@ -101,14 +126,20 @@ class RogersExperiment2b(Experiment):
         else:
             raise ValueError("{} has invalid learning gene value of {}".format(node, gene))
 
+    @coalesced
     def info_post_request(self, node, info):
         node.calculate_fitness()
 
-        ts = Transmission.query.filter_by(destination_id=node.id, status="received").with_entities(Transmission.info_id).all()
-        infos = Info.query.filter(Info.id.in_([t.info_id for t in ts])).all()
+        infos = received_infos(db.session()).params(node_id=node.id).all()
         stimulus = [i for i in infos if type(i) in [State, Meme]][0]
         transformations.Response(info_in=stimulus, info_out=info)
 
+        kind = network_kind(node.network_id)
+        if kind is not None:
+            if node.infos(type=LearningGene)[0].contents == "asocial":
+                kind = "asocial"
+            count_generation_stats(self.session, node.generation, kind, correct=node.score)
+
     def submission_successful(self, participant=None):
 
         key = participant.uniqueid[0:5]
@@ -131,6 +162,9 @@ class RogersExperiment2b(Experiment):
             environments = Environment.query.filter(Environment.network_id.in_(networks)).all()
             for e in environments:
                 e.step()
+            count_generation_stats(
+                self.session, current_generation, "environment",
+                count=len([e for e in environments if network_kind(e.network_id) is not None]))
         else:
             pass
 
@@ -138,7 +172,7 @@ class RogersExperiment2b(Experiment):
         key = "-----"
         participants = Participant.query.with_entities(Participant.status).all()
 
-        # if all networks are full, close recruitment,
+        # if all networks are full, close recruitment
         if not self.networks(full=False):
             self.log("All networks are full, closing recruitment.", key)
             self.recruiter().close_recruitment()
@@ -157,26 +191,55 @@ class RogersExperiment2b(Experiment):
             self.log("Networks not full, no-one current participating, but generation not full: not recruiting.", key)
             pass
 
+    def archive_networks(self, networks=None):
+        """Move the rows of full networks into the archive tables, one network per transaction."""
+        # the networks stay in the network table, so self.networks() still
+        # finds them, but the rest of their rows are only read through
+        # with_archive()
+        if networks is None:
+            networks = self.networks(full=True)
+        ids = [net.id for net in networks if net.full]
+        if ids:
+            ids = [n.network_id for n in Node.query.with_entities(Node.network_id)
+                                                .filter(Node.network_id.in_(ids))
+                                                .distinct().all()]
+        if not ids:
+            return []
+
+        tables = db.Base.metadata.tables
+        for network_id in ids:
+            connection = self.session.connection()
+            for name in archived_tables:
+                hot = tables[name]
+                connection.execute(
+                    archive_table(name).insert().from_select(
+                        [c.name for c in hot.columns],
+                        select([hot]).where(hot.c.network_id == network_id)))
+            for name in reversed(archived_tables):
+                hot = tables[name]
+                connection.execute(hot.delete().where(hot.c.network_id == network_id))
+            self.session.commit()
+            self.log("Archived network {}".format(network_id))
+        self.session.expire_all()
+
+        return ids
+
     def bonus(self, participant=None):
         if participant is None:
             raise(ValueError("You must specify the participant to calculate the bonus."))
         participant_id = participant.uniqueid
         key = participant_id[0:5]
 
-        nodes = Node.query.join(Node.network)\
-                    .filter(and_(Node.participant_id == participant_id,
-                                 Network.role == "experiment"))\
-                    .all()
+        nodes = participant_nodes(db.session()).params(participant_id=participant_id, role="experiment").all()
         if len(nodes) == 0:
             self.log("Participant has 0 nodes - cannot calculate bonus!", key)
             return 0
 
-        node_ids = [n.id for n in nodes]
-        genes = LearningGene.query.filter(LearningGene.origin_id.in_(node_ids)).all()
+        genes = dict(participant_genes(db.session()).params(participant_id=participant_id).all())
 
         scores = []
         for node in nodes:
-            gene = [g for g in genes if g.origin_id == node.id][0].contents
+            gene = genes[node.id]
             if gene == "asocial":
                 scores.append(node.score)
             else:
@@ -192,13 +255,10 @@ class RogersExperiment2b(Experiment):
 
         key = participant.uniqueid[0:5]
 
-        participant_nodes = Node.query.join(Node.network)\
-                                .filter(and_(Node.participant_id == participant.uniqueid,
-                                             Network.role == "catch"))\
-                                .all()
-        scores = [n.score for n in participant_nodes]
+        catch_nodes = participant_nodes(db.session()).params(participant_id=participant.uniqueid, role="catch").all()
+        scores = [n.score for n in catch_nodes]
 
-        if participant_nodes:
+        if catch_nodes:
             avg = sum(scores)/float(len(scores))
         else:
             self.log("Participant has no nodes from catch networks, passing by default", key)
@@ -244,7 +304,7 @@ class LearningGene(Gene):
 
     def _mutated_contents(self):
         alleles = ["social", "asocial"]
-        return random.choice([a for a in alleles if a != self.contents])
+        return rng(self.network_id).choice([a for a in alleles if a != self.contents])
 
 
 class RogersSource(Source):
@@ -288,64 +348,25 @@ class RogersSocialSource(Source):
         elif not isinstance(agent, Agent):
             raise ValueError("Rogers social source _what must be sent a node")
 
+        session = db.session()
         if self.kind == "single_agent":
-            parent = random.choice(RogersAgent.query.filter_by(generation=(agent.generation-1), failed=False, network_id=agent.network_id).with_entities(RogersAgent.id).all())
-            parents_meme = Meme.query.filter_by(origin_id=parent.id).all()[0]
+            parent = rng(agent.network_id).choice(previous_agents(session).params(generation=(agent.generation-1), network_id=agent.network_id).all())
+            parents_meme = memes_by_origin(session).params(origin_id=parent.id).all()[0]
             new_meme = Meme(origin=self, contents=parents_meme.contents)
             transformations.Replication(info_in=parents_meme, info_out=new_meme)
         elif self.kind == "single_generation":
-            generation = RogersAgent.query.filter_by(generation=(agent.generation-1), failed=False, network_id=agent.network_id).with_entities(RogersAgent.id).all()
-            ids = [n.id for n in generation]
-            memes = Meme.query.filter(Meme.origin_id.in_(ids)).all()
-            n_blue = 0
-            n_yellow = 0
-            for m in memes:
-                if m.contents == "blue":
-                    n_blue += 1
-                elif m.contents == "yellow":
-                    n_yellow += 1
-                else:
-                    raise ValueError("Meme cannot have contents other than yellow or blue, but contents is {}".format(m.contents))
-            summary = {"blue": n_blue, "yellow": n_yellow}
+            summary = {"blue": 0, "yellow": 0}
+            for generation, contents in previous_memes(session).params(oldest=(agent.generation-1), newest=(agent.generation-1), network_id=agent.network_id):
+                if contents not in summary:
+                    raise ValueError("Meme cannot have contents other than yellow or blue, but contents is {}".format(contents))
+                summary[contents] += 1
             new_meme = Meme(origin=self, contents=dumps(summary))
         elif self.kind == "triple_generation":
-            generation1 = RogersAgent.query.filter_by(generation=(agent.generation-1), failed=False, network_id=agent.network_id).with_entities(RogersAgent.id).all()
-            generation2 = RogersAgent.query.filter_by(generation=(agent.generation-2), failed=False, network_id=agent.network_id).with_entities(RogersAgent.id).all()
-            generation3 = RogersAgent.query.filter_by(generation=(agent.generation-3), failed=False, network_id=agent.network_id).with_entities(RogersAgent.id).all()
-            ids1 = [n.id for n in generation1]
-            ids2 = [n.id for n in generation2]
-            ids3 = [n.id for n in generation3]
-            memes1 = Meme.query.filter(Meme.origin_id.in_(ids1)).all()
-            memes2 = Meme.query.filter(Meme.origin_id.in_(ids2)).all()
-            memes3 = Meme.query.filter(Meme.origin_id.in_(ids3)).all()
-            n_blue1 = 0
-            n_yellow1 = 0
-            n_blue2 = 0
-            n_yellow2 = 0
-            n_blue3 = 0
-            n_yellow3 = 0
-            for m in memes1:
-                if m.contents == "blue":
-                    n_blue1 += 1
-                elif m.contents == "yellow":
-                    n_yellow1 += 1
-                else:
-                    raise ValueError("Meme cannot have contents other than yellow or blue, but contents is {}".format(m.contents))
-            for m in memes2:
-                if m.contents == "blue":
-                    n_blue2 += 1
-                elif m.contents == "yellow":
-                    n_yellow2 += 1
-                else:
-                    raise ValueError("Meme cannot have contents other than yellow or blue, but contents is {}".format(m.contents))
-            for m in memes3:
-                if m.contents == "blue":
-                    n_blue3 += 1
-                elif m.contents == "yellow":
-                    n_yellow3 += 1
-                else:
-                    raise ValueError("Meme cannot have contents other than yellow or blue, but contents is {}".format(m.contents))
-            summary = {"blue1": n_blue1, "yellow1": n_yellow1, "blue2": n_blue2, "yellow2": n_yellow2, "blue3": n_blue3, "yellow3": n_yellow3}
+            summary = {"blue1": 0, "yellow1": 0, "blue2": 0, "yellow2": 0, "blue3": 0, "yellow3": 0}
+            for generation, contents in previous_memes(session).params(oldest=(agent.generation-3), newest=(agent.generation-1), network_id=agent.network_id):
+                if contents not in ["blue", "yellow"]:
+                    raise ValueError("Meme cannot have contents other than yellow or blue, but contents is {}".format(contents))
+                summary["{}{}".format(contents, agent.generation - generation)] += 1
             new_meme = Meme(origin=self, contents=dumps(summary))
         else:
             raise ValueError("Rogers social source cannot be {}".format(self.kind))
@@ -406,15 +427,13 @@ class RogersAgent(Agent):
 
     def calculate_fitness(self):
 
-        from operator import attrgetter
-
         if self.fitness is not None:
             raise Exception("You are calculating the fitness of agent {}, ".format(self.id) +
                             "but they already have a fitness")
         infos = self.infos()
 
         said_blue = ([i for i in infos if isinstance(i, Meme)][0].contents == "blue")
-        proportion = float(max(State.query.filter_by(network_id=self.network_id).all(), key=attrgetter('creation_time')).contents)
+        proportion = float(current_state(db.session()).params(network_id=self.network_id).first().contents)
         self.proportion = proportion
         is_blue = proportion > 0.5
 
@@ -437,7 +456,7 @@ class RogersAgent(Agent):
     def update(self, infos):
         for info_in in infos:
             if isinstance(info_in, LearningGene):
-                if random.random() < 0.10:
+                if rng(self.network_id).random() < 0.10:
                     self.mutate(info_in)
                 else:
                     self.replicate(info_in)
@@ -464,7 +483,7 @@ class RogersEnvironment(Environment):
         super(RogersEnvironment, self).__init__(*args, **kwargs)
         if proportion is None:
             raise(ValueError("You need to pass RogersEnvironment a proprtion when you make it."))
-        elif random.random() < 0.5:
+        elif rng(self.network_id).random() < 0.5:
             proportion = 1 - proportion
         State(
             origin=self,
@@ -480,7 +499,59 @@ class RogersEnvironment(Environment):
         info_out = State(origin=self, contents=new_contents)
         transformations.Mutation(info_in=current_state, info_out=info_out)
 
-from wallace import db
+
+# A network's role and social source never change after setup, so the kind
+# of each network is looked up once per process.
+network_kinds = {}
+
+
+def network_kind(network_id):
+    """The kind of social source of an experiment network, or None for practice and catch networks."""
+    if network_id not in network_kinds:
+        role = Network.query.with_entities(Network.role).filter_by(id=network_id).scalar()
+        kind = RogersSocialSource.query.with_entities(RogersSocialSource.kind)\
+                                       .filter_by(network_id=network_id).scalar()
+        network_kinds[network_id] = kind if role == "experiment" else None
+    return network_kinds[network_id]
+
+
+# The hot queries, compiled once and then found in queries.query_cache.
+previous_agents = baked_query(lambda s: s.query(RogersAgent.id))
+previous_agents += lambda q: q.filter(
+    RogersAgent.generation == bindparam("generation"),
+    RogersAgent.failed == False,
+    RogersAgent.network_id == bindparam("network_id")).order_by(RogersAgent.id)
+
+memes_by_origin = baked_query(lambda s: s.query(Meme))
+memes_by_origin += lambda q: q.filter(Meme.origin_id == bindparam("origin_id"))
+
+previous_memes = baked_query(lambda s: s.query(RogersAgent.generation, Meme.contents).join(
+    RogersAgent, Meme.origin_id == RogersAgent.id))
+previous_memes += lambda q: q.filter(
+    RogersAgent.generation >= bindparam("oldest"),
+    RogersAgent.generation <= bindparam("newest"),
+    RogersAgent.failed == False,
+    RogersAgent.network_id == bindparam("network_id"))
+
+received_infos = baked_query(lambda s: s.query(Info).join(
+    Transmission, Transmission.info_id == Info.id))
+received_infos += lambda q: q.filter(
+    Transmission.destination_id == bindparam("node_id"),
+    Transmission.status == "received")
+
+participant_nodes = baked_query(lambda s: s.query(Node).join(Node.network))
+participant_nodes += lambda q: q.filter(
+    Node.participant_id == bindparam("participant_id"),
+    Network.role == bindparam("role"))
+
+participant_genes = baked_query(lambda s: s.query(LearningGene.origin_id, LearningGene.contents).join(
+    Node, LearningGene.origin_id == Node.id))
+participant_genes += lambda q: q.filter(Node.participant_id == bindparam("participant_id"))
+
+current_state = baked_query(lambda s: s.query(State.contents))
+current_state += lambda q: q.filter(State.network_id == bindparam("network_id")).order_by(
+    State.creation_time.desc(), State.id.desc())
+
 
 extra_routes = Blueprint(
     'extra_routes', __name__,
@@ -488,6 +559,50 @@ extra_routes = Blueprint(
     static_folder='static')
 
 
+@extra_routes.record
+def check_assets(state):
+    # the pages fall back to the unbundled files only when debugging
+    if not assets.manifest and not state.app.testing and experiment_config().get("Experiment Configuration", "mode") != "debug":
+        raise RuntimeError(
+            "There is no build of the static files in {}: run python assets.py before deploying.".format(assets.build_dir))
+
+
+@extra_routes.app_context_processor
+def static_assets():
+    return {"assets": assets.manifest}
+
+
+@extra_routes.route("/assets/<filename>", methods=["GET"])
+def asset(filename):
+
+    if filename not in assets.manifest.values():
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    path, encoding = assets.encoded_file(assets.build_dir, filename, request.headers.get("Accept-Encoding", ""))
+    response = send_file(path, mimetype=mimetype)
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+@extra_routes.before_app_request
+def route_reads_to_replica():
+    if request.method == "GET":
+        session = read_session(request.path, info_type=request.values.get("info_type"))
+        if session is not None:
+            db.session.registry.set(session)
+            g.replica_session = True
+
+
+@extra_routes.teardown_app_request
+def close_replica_session(exception=None):
+    if getattr(g, "replica_session", False):
+        db.session.remove()
+
+
 @extra_routes.route("/saw_the_dots", methods=["POST"])
 def saw_the_dots():
 
@@ -530,3 +645,26 @@ def saw_the_dots():
 
     data = {"status": "success"}
     return Response(dumps(data), status=200, mimetype='application/json')
+
+
+# A state's dot layout is sent in the same response as the state, so the
+# stimulus can be shown as soon as the state arrives.
+info_route = re.compile(r"^/info/\d+/\d+$")
+
+
+@extra_routes.after_app_request
+def add_dot_layout(response):
+    if request.method == "GET" and response.status_code == 200 and info_route.match(request.path):
+        data = loads(response.get_data(as_text=True))
+        info = data.get("info") or {}
+        if info.get("type") == "state":
+            data["layout"] = colored_dot_layout(float(info["contents"]))
+            response.set_data(dumps(data, separators=(',', ':')))
+    return response
+
+
+@extra_routes.route("/dashboard/stream", methods=["GET"])
+@requires_login
+def dashboard_stream():
+    return Response(stream_with_context(dashboard_events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
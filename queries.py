@@ -0,0 +1,40 @@
+"""A cache of compiled queries that counts its hits."""
+
+from sqlalchemy.ext import baked
+
+
+# The hot queries are built and compiled once, then reused with new bound
+# parameters. Their compiled forms are kept in query_cache, which counts how
+# often a lookup finds one there.
+class QueryCache(dict):
+    """A cache of compiled queries that counts its hits and misses."""
+
+    def __init__(self):
+        super(QueryCache, self).__init__()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self:
+            self.hits += 1
+            return self[key]
+        self.misses += 1
+        return default
+
+
+query_cache = QueryCache()
+
+
+def baked_query(fn):
+    """A baked query starting with fn(session), cached in query_cache."""
+    return baked.BakedQuery(query_cache, fn)
+
+
+def query_cache_stats():
+    """The hits, misses, hit rate and size of the query cache."""
+    lookups = query_cache.hits + query_cache.misses
+    return {
+        "hits": query_cache.hits,
+        "misses": query_cache.misses,
+        "hit_rate": float(query_cache.hits)/lookups if lookups else None,
+        "size": len(query_cache)}
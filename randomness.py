@@ -0,0 +1,65 @@
+"""Seeded random streams, one for each network."""
+
+from contextlib import contextmanager
+import hashlib
+import random
+
+# Randomness comes from the global random module unless the experiment is
+# seeded. Seeded runs give every network its own stream, so a run can be
+# replayed exactly whatever order its networks are visited in.
+rng_seed = None
+rng_streams = {}
+
+
+def seed_rng(seed):
+    """Seed the random streams and the random module, or unseed them with None."""
+    global rng_seed
+    rng_seed = seed
+    rng_streams.clear()
+    random.seed(seed)
+
+
+def rng(network_id=None):
+    """The random stream for a network, or for the experiment if network_id is None."""
+    if rng_seed is None:
+        return random
+    if network_id not in rng_streams:
+        key = "{}:{}".format(rng_seed, network_id).encode("utf-8")
+        rng_streams[network_id] = random.Random(int(hashlib.sha1(key).hexdigest(), 16))
+    return rng_streams[network_id]
+
+
+@contextmanager
+def network_rng(network_id):
+    """Make the draws wallace makes from the random module come from a network's stream."""
+    if rng_seed is None:
+        yield
+        return
+    stream = rng(network_id)
+    saved_state = random.getstate()
+    random.setstate(stream.getstate())
+    try:
+        yield
+    finally:
+        stream.setstate(random.getstate())
+        random.setstate(saved_state)
+
+
+def rng_state():
+    """The state of every random stream, so a run can be resumed exactly."""
+    return {
+        "seed": rng_seed,
+        "streams": dict((k, s.getstate()) for k, s in rng_streams.items()),
+        "random": random.getstate()
+    }
+
+
+def set_rng_state(state):
+    """Restore random streams saved with rng_state()."""
+    global rng_seed
+    rng_seed = state["seed"]
+    rng_streams.clear()
+    for network_id, stream_state in state["streams"].items():
+        rng_streams[network_id] = random.Random()
+        rng_streams[network_id].setstate(stream_state)
+    random.setstate(state["random"])
@@ -0,0 +1,60 @@
+"""Send read-only participant requests to a replica of the database."""
+
+from wallace.models import Info, Transmission
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from settings import experiment_config
+import os
+import re
+
+# The replica is set with replica_url in config.txt or the
+# REPLICA_DATABASE_URL environment variable, and connected to the first
+# time a request needs it. The pending transmissions request is not one of
+# the routes served, as it receives the transmissions it returns.
+replica = {}
+replica_routes = [
+    re.compile(r"^/node/(?P<node_id>\d+)/infos$"),
+    re.compile(r"^/info/(?P<node_id>\d+)/(?P<info_id>\d+)$"),
+]
+
+
+def replica_engine():
+    """The engine of the replica, or None if there is no replica."""
+    if "engine" not in replica:
+        url = os.environ.get("REPLICA_DATABASE_URL")
+        if url is None and experiment_config().has_option("Database Parameters", "replica_url"):
+            url = experiment_config().get("Database Parameters", "replica_url")
+        if url in ["", "None", "none"]:
+            url = None
+        replica["engine"] = create_engine(url) if url else None
+    return replica["engine"]
+
+
+def replica_is_fresh(session, node_id, info_id=None, info_type=None):
+    """Whether the replica has the node's infos of info_type, or the info it made or received."""
+    if info_id is None:
+        info_class = Info
+        if info_type is not None:
+            classes = [m.class_ for m in Info.__mapper__.polymorphic_map.values() if m.class_.__name__ == info_type]
+            if not classes:
+                return False
+            info_class = classes[0]
+        return session.query(info_class.id).filter(info_class.origin_id == node_id).first() is not None
+    return (session.query(Info.id).filter_by(id=info_id, origin_id=node_id).first() is not None or
+            session.query(Transmission.id).filter_by(info_id=info_id, destination_id=node_id, status="received").first() is not None)
+
+
+def read_session(path, engine=None, info_type=None):
+    """A replica session for a read-only request it has caught up with, or None to use the primary."""
+    engine = engine or replica_engine()
+    if engine is None:
+        return None
+    for route in replica_routes:
+        match = route.match(path)
+        if match:
+            session = Session(bind=engine)
+            ids = dict((k, int(v)) for k, v in match.groupdict().items())
+            if replica_is_fresh(session, info_type=info_type, **ids):
+                return session
+            session.close()
+    return None
@@ -0,0 +1,13 @@
+"""The experiment's config.txt, loaded the first time it is needed."""
+
+from psiturk.psiturk_config import PsiturkConfig
+
+config = {}
+
+
+def experiment_config():
+    """The experiment's config.txt."""
+    if "config" not in config:
+        config["config"] = PsiturkConfig()
+        config["config"].load_config()
+    return config["config"]
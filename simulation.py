@@ -0,0 +1,579 @@
+"""Simulate participants, and checkpoint and restore simulated runs."""
+
+from __future__ import print_function
+from wallace import db
+from wallace.information import Meme, State
+from wallace.nodes import Environment
+from psiturk.db import db_session as session_psiturk
+from psiturk.models import Participant
+from experiment import RogersExperiment2b, network_kinds
+from randomness import rng, rng_state, set_rng_state
+from stats import GenerationStats, count_generation_stats
+from transactions import unit_of_work
+from sqlalchemy import create_engine, event, func
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql.expression import select, text
+from datetime import datetime, timedelta
+from operator import attrgetter
+import argparse
+import hashlib
+import multiprocessing
+import os
+import pickle
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import uuid
+
+
+def is_sqlite(url):
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def sqlite_path(url):
+    """The file of the SQLite database at url, or None if it is in memory."""
+    database = make_url(url).database
+    return None if database in [None, "", ":memory:"] else database
+
+
+def sqlite_engine(url):
+    """An engine for the SQLite database at url, tuned for simulations.
+
+    Files use write-ahead logging, so participants' reads do not wait for
+    writes. Nothing is synced to disk: a simulation that crashes is simply
+    run again. An in-memory database lives in a single connection shared
+    by every session in the process.
+    """
+    path = sqlite_path(url)
+    if path is None:
+        engine = create_engine(url, poolclass=StaticPool, connect_args={"check_same_thread": False})
+    else:
+        engine = create_engine(url)
+
+    @event.listens_for(engine, "connect")
+    def tune(connection, record):
+        cursor = connection.cursor()
+        if path is not None:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=OFF")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    return engine
+
+
+def use_database(url):
+    """Point both the wallace and psiturk sessions at the database at url.
+
+    url may be a Postgres database or an embedded SQLite one, either a file
+    (sqlite:///path) or in memory (sqlite://).
+    """
+    db.session.remove()
+    session_psiturk.remove()
+    db.engine.dispose()
+    db.db_url = url
+    db.engine = sqlite_engine(url) if is_sqlite(url) else create_engine(url)
+    db.session.configure(bind=db.engine)
+    session_psiturk.configure(bind=db.engine)
+    return db.engine
+
+
+def use_simulation_database():
+    """Use the database in SIMULATION_DATABASE_URL, if it is set."""
+    url = os.environ.get("SIMULATION_DATABASE_URL")
+    if url:
+        use_database(url)
+
+
+def schema():
+    """The statements that create the experiment's tables in the database in use."""
+    tables = db.Base.metadata.sorted_tables + [Participant.__table__]
+    return ";\n".join(str(CreateTable(table).compile(dialect=db.engine.dialect)) for table in tables)
+
+
+def schema_template():
+    """The path of an empty SQLite database with the experiment's schema.
+
+    The template is made once and shared by every run with the same schema.
+    """
+    path = os.path.join(tempfile.gettempdir(), "rogers_schema_{}.sqlite".format(
+        hashlib.sha1(schema().encode("utf-8")).hexdigest()[:12]))
+    if not os.path.exists(path):
+        partial = "{}.{}".format(path, os.getpid())
+        engine = create_engine("sqlite:///" + partial)
+        db.Base.metadata.create_all(bind=engine)
+        Participant.__table__.create(bind=engine)
+        engine.dispose()
+        os.rename(partial, path)
+    return path
+
+
+def reset_database():
+    """Empty the database, including the participant table.
+
+    A SQLite database is replaced by a copy of the schema template rather
+    than having its tables dropped and made again.
+    """
+    if is_sqlite(db.db_url):
+        load_sqlite(schema_template())
+        return db.get_session()
+    session = db.init_db(drop_all=True)
+    Participant.__table__.drop(bind=db.engine, checkfirst=True)
+    Participant.__table__.create(bind=db.engine)
+    return session
+
+
+def completed_participants():
+    """The number of participants who have finished the experiment."""
+    return Participant.query.filter_by(status=101).count()
+
+
+def simulate_participant(exp, number, accuracy=0.75, timings=None, coalesce=False):
+    """Run one simulated participant through every network.
+
+    Each trial makes the same calls, in the same order, as the /node and
+    /info routes and the pending transmissions request do when a real
+    participant takes part. The participant then submits, which runs the
+    generation barrier in submission_successful. Answers are right with
+    probability accuracy.
+
+    If coalesce is true every trial is written in a single transaction,
+    committed before the participant submits, since the participant's
+    status is changed through psiturk's own session.
+
+    If timings is a dict, the time spent being assigned nodes and posting
+    answers is added to its "assignment" and "processing" entries.
+    """
+    participant = Participant(
+        workerid="sim{}".format(number), assignmentid="sim{}".format(number),
+        hitid="simulation", mode="debug")
+    session_psiturk.add(participant)
+    session_psiturk.commit()
+    participant_id = participant.uniqueid
+
+    if coalesce:
+        with unit_of_work(exp.session):
+            simulate_trials(exp, participant_id, accuracy, timings)
+    else:
+        simulate_trials(exp, participant_id, accuracy, timings)
+
+    participant.status = 101
+    session_psiturk.commit()
+    exp.submission_successful(participant=participant)
+    exp.save()
+    return participant
+
+
+def simulate_trials(exp, participant_id, accuracy, timings):
+    """Take a participant through a trial in every network they can join."""
+    while True:
+        assign_start_time = datetime.now()
+        network = exp.get_network_for_participant(participant_id=participant_id)
+        if network is None:
+            break
+        node = exp.create_node(participant_id=participant_id, network=network)
+        exp.add_node_to_network(participant_id=participant_id, node=node, network=network)
+        exp.save()
+        exp.node_post_request(participant_id=participant_id, node=node)
+        exp.save()
+        assign_stop_time = datetime.now()
+
+        node.receive()
+        exp.save()
+
+        environment = network.nodes(type=Environment)[0]
+        state = max(environment.infos(type=State), key=attrgetter('creation_time'))
+        right_answer = "blue" if float(state.contents) > 0.5 else "yellow"
+        wrong_answer = "yellow" if right_answer == "blue" else "blue"
+        if rng(node.network_id).random() < accuracy:
+            answer = right_answer
+        else:
+            answer = wrong_answer
+        exp.info_post_request(node=node, info=Meme(origin=node, contents=answer))
+        exp.save()
+        process_stop_time = datetime.now()
+
+        if timings is not None:
+            timings["assignment"] = timings.get("assignment", timedelta()) + (assign_stop_time - assign_start_time)
+            timings["processing"] = timings.get("processing", timedelta()) + (process_stop_time - assign_stop_time)
+
+
+def simulate(exp, participants=None, timings=None, coalesce=False):
+    """Simulate participants until the networks are full.
+
+    If participants is given, stop after that many more participants
+    instead. The very first participant always answers correctly, the rest
+    are right 75% of the time. Returns the total number of participants who
+    have completed the experiment.
+    """
+    done = completed_participants()
+    stop = None if participants is None else done + participants
+    while exp.networks(full=False) and (stop is None or done < stop):
+        accuracy = 1.0 if done == 0 else 0.75
+        simulate_participant(exp, done, accuracy=accuracy, timings=timings, coalesce=coalesce)
+        done += 1
+    return done
+
+
+def save_checkpoint(path):
+    """Save the database and random state of a run into the directory path.
+
+    A Postgres database is saved with pg_dump, so the checkpoint can be
+    restored into any local Postgres database with load_checkpoint(). A
+    SQLite database is saved as a SQLite file, and can be restored into any
+    SQLite database, in a file or in memory.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    db.session.commit()
+    session_psiturk.commit()
+    if is_sqlite(db.db_url):
+        save_sqlite(os.path.join(path, "database.sqlite"))
+    else:
+        subprocess.check_call([
+            "pg_dump", "--format=custom", "--no-owner",
+            "--file={}".format(os.path.join(path, "database.dump")),
+            "--dbname={}".format(libpq_url(db.db_url))])
+    with open(os.path.join(path, "state.pickle"), "wb") as f:
+        pickle.dump({"rng": rng_state()}, f)
+
+
+def load_checkpoint(path):
+    """Restore a checkpoint made by save_checkpoint() into the database.
+
+    Anything already in the database is replaced. Returns a fresh session,
+    and the random streams carry on from where the checkpoint was taken.
+    """
+    if is_sqlite(db.db_url):
+        load_sqlite(os.path.join(path, "database.sqlite"))
+    else:
+        db.session.remove()
+        session_psiturk.remove()
+        db.engine.dispose()
+        subprocess.check_call([
+            "pg_restore", "--clean", "--if-exists", "--no-owner",
+            "--dbname={}".format(libpq_url(db.db_url)),
+            os.path.join(path, "database.dump")])
+    with open(os.path.join(path, "state.pickle"), "rb") as f:
+        state = pickle.load(f)
+    set_rng_state(state["rng"])
+    network_kinds.clear()
+    return db.get_session()
+
+
+def libpq_url(url):
+    """The url of a Postgres database without its SQLAlchemy driver name.
+
+    pg_dump and pg_restore do not accept urls like postgresql+psycopg2://.
+    """
+    url = make_url(url)
+    url.drivername = "postgresql"
+    return str(url)
+
+
+def save_sqlite(path):
+    """Copy the SQLite database in use to a file at path.
+
+    A file is copied once its write-ahead log has been written back into
+    it. An in-memory database is dumped as SQL and loaded into the file.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    source = sqlite_path(db.db_url)
+    if source is not None:
+        db.engine.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        shutil.copyfile(source, path)
+        return
+    connection = db.engine.raw_connection()
+    try:
+        copy = sqlite3.connect(path)
+        copy.executescript("\n".join(connection.connection.iterdump()))
+        copy.close()
+    finally:
+        connection.close()
+
+
+def load_sqlite(path):
+    """Replace the SQLite database in use with a copy of the file at path."""
+    db.session.remove()
+    session_psiturk.remove()
+    db.engine.dispose()
+    target = sqlite_path(db.db_url)
+    if target is not None:
+        for suffix in ["-wal", "-shm"]:
+            if os.path.exists(target + suffix):
+                os.remove(target + suffix)
+        shutil.copyfile(path, target)
+        return
+    source = sqlite3.connect(path)
+    script = "\n".join(source.iterdump())
+    source.close()
+    connection = db.engine.raw_connection()
+    try:
+        connection.connection.executescript(script)
+    finally:
+        connection.close()
+
+
+def shard_urls(url, shards):
+    """The urls of the shards' databases for one parallel run.
+
+    Each run gets databases of its own, so runs do not collide. Shards of
+    a SQLite database are files in a new temporary directory, since the
+    parent process has to read them when merging. Shards of a Postgres
+    database are databases named after it and the run.
+    """
+    urls = []
+    if is_sqlite(url):
+        directory = tempfile.mkdtemp(prefix="rogers_shards_")
+    else:
+        run = uuid.uuid4().hex[:12]
+    for shard in range(shards):
+        shard_url = make_url(url)
+        if is_sqlite(url):
+            shard_url.database = os.path.join(directory, "shard{}.sqlite".format(shard))
+        else:
+            shard_url.database = "{}_{}_shard{}".format(shard_url.database, run, shard)
+        urls.append(str(shard_url))
+    return urls
+
+
+def drop_shards(urls):
+    """Delete the databases made for a parallel run's shards."""
+    if is_sqlite(urls[0]):
+        shutil.rmtree(os.path.dirname(sqlite_path(urls[0])), ignore_errors=True)
+        return
+    url = make_url(urls[0])
+    url.database = "postgres"
+    engine = create_engine(url, isolation_level="AUTOCOMMIT")
+    for shard_url in urls:
+        engine.execute('DROP DATABASE IF EXISTS "{}"'.format(make_url(shard_url).database))
+    engine.dispose()
+
+
+def create_database(url):
+    """Create the Postgres database at url unless it already exists.
+
+    SQLite files are made when they are first used.
+    """
+    if is_sqlite(url):
+        return
+    url = make_url(url)
+    name = url.database
+    url.database = "postgres"
+    engine = create_engine(url, isolation_level="AUTOCOMMIT")
+    exists = engine.execute(
+        text("SELECT 1 FROM pg_database WHERE datname = :name"), name=name).scalar()
+    if not exists:
+        engine.execute('CREATE DATABASE "{}"'.format(name))
+    engine.dispose()
+
+
+def max_ids():
+    """The largest id in each of the wallace tables."""
+    return dict(
+        (table.name, db.engine.execute(select([func.max(table.c.id)])).scalar() or 0)
+        for table in db.Base.metadata.sorted_tables)
+
+
+def run_shard(connection, url, seed, shard, shards, coalesce=False):
+    """Simulate one shard of the networks in a worker process.
+
+    Every shard sets up all the networks exactly as a serial run would, then
+    closes the ones it does not own so that its participants only visit its
+    own. The parent sends the number of participants to simulate for each
+    generation and waits for every shard to finish before sending the next,
+    so the shards pass the generation barrier together.
+    """
+    use_database(url)
+    session = reset_database()
+    exp = RogersExperiment2b(session, seed=seed)
+    exp.verbose = False
+
+    networks = sorted(exp.networks(), key=attrgetter("id"))
+    owned = [net.id for net in networks[shard::shards]]
+    for net in networks:
+        if net.id not in owned:
+            net.full = True
+    exp.save()
+    connection.send((owned, max_ids(), exp.generation_size))
+
+    while True:
+        participants = connection.recv()
+        if participants is None:
+            break
+        simulate(exp, participants=participants, coalesce=coalesce)
+        connection.send(not exp.networks(full=False))
+
+    connection.send(max_ids())
+    connection.close()
+
+
+def merge_shards(urls, owners, setup_ids, shard_ids):
+    """Copy the networks each shard owns into the current database.
+
+    Rows created during setup are identical in every shard and keep their
+    ids. Rows created by the simulation get their ids shifted past those of
+    the shards before them, and so do any references to them. The generation
+    stats of the shards are added together.
+
+    Nodes refer to participants by their uniqueid. Every shard simulates the
+    same participants, named sim<n> in the same order, so one copy of the
+    participant table serves them all. The shards are checked to have the
+    same participants before anything is merged.
+    """
+    table = Participant.__table__
+    participants = []
+    for url in urls:
+        engine = create_engine(url)
+        participants.append([dict(row) for row in engine.execute(select([table]).order_by(table.c.uniqueid))])
+        engine.dispose()
+    names = [[p["uniqueid"] for p in shard_participants] for shard_participants in participants]
+    for shard, shard_names in enumerate(names):
+        if shard_names != names[0]:
+            raise ValueError("Shard {} has different participants from shard 0, so the shards cannot be merged.".format(shard))
+
+    session = reset_database()
+    offsets = dict((name, 0) for name in setup_ids)
+
+    for shard, url in enumerate(urls):
+        engine = create_engine(url)
+        for table in db.Base.metadata.sorted_tables:
+            if "network_id" in table.c:
+                query = select([table]).where(table.c.network_id.in_(owners[shard]))
+            elif table.name == "network":
+                query = select([table]).where(table.c.id.in_(owners[shard]))
+            elif shard == 0:
+                query = select([table])
+            elif table is GenerationStats.__table__:
+                # every shard steps every environment, so flips are only
+                # counted once
+                for row in engine.execute(select([table]).where(table.c.kind != "environment")):
+                    count_generation_stats(db.engine, row.generation, row.kind, count=row.count, correct=row.correct)
+                continue
+            else:
+                continue
+
+            references = dict((fk.parent.name, fk.column.table.name) for fk in table.foreign_keys)
+            references["id"] = table.name
+            rows = []
+            for row in engine.execute(query):
+                row = dict(row)
+                for column, referenced in references.items():
+                    if row[column] is not None and row[column] > setup_ids[referenced]:
+                        row[column] += offsets[referenced]
+                rows.append(row)
+            if rows:
+                db.engine.execute(table.insert(), rows)
+
+        if shard == 0 and participants[0]:
+            db.engine.execute(Participant.__table__.insert(), participants[0])
+        for name in offsets:
+            offsets[name] += shard_ids[shard][name] - setup_ids[name]
+        engine.dispose()
+
+    if db.engine.dialect.name == "postgresql":
+        for table in db.Base.metadata.sorted_tables:
+            db.engine.execute(text(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "coalesce(max(id), 0) + 1, false) FROM {0}".format(table.name)))
+    return session
+
+
+def simulate_parallel(seed, shards=None, generations=None, coalesce=False):
+    """Simulate the experiment across a pool of worker processes.
+
+    The networks are split between shards, each with a database of its own
+    that is deleted once the results are merged back into the current
+    database. Because every network draws from its own random stream, a
+    seeded parallel run produces the same networks as a serial run with
+    the same seed. Returns a session on the merged database.
+    """
+    if shards is None:
+        shards = multiprocessing.cpu_count()
+    main_url = db.db_url
+    urls = shard_urls(main_url, shards)
+    workers = []
+    try:
+        for url in urls:
+            create_database(url)
+
+        db.session.remove()
+        session_psiturk.remove()
+        db.engine.dispose()
+
+        connections = []
+        for shard, url in enumerate(urls):
+            connection, child_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=run_shard, args=(child_connection, url, seed, shard, shards, coalesce))
+            worker.start()
+            connections.append(connection)
+            workers.append(worker)
+
+        owners = []
+        for connection in connections:
+            owned, setup_ids, generation_size = connection.recv()
+            owners.append(owned)
+
+        generation = 0
+        while generations is None or generation < generations:
+            for connection in connections:
+                connection.send(generation_size)
+            finished = [connection.recv() for connection in connections]
+            generation += 1
+            if all(finished):
+                break
+
+        for connection in connections:
+            connection.send(None)
+        shard_ids = [connection.recv() for connection in connections]
+        for worker in workers:
+            worker.join()
+
+        use_database(main_url)
+        return merge_shards(urls, owners, setup_ids, shard_ids)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        drop_shards(urls)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the Rogers experiment.")
+    parser.add_argument("--seed", type=int, default=None, help="seed for a reproducible run")
+    parser.add_argument("--resume", metavar="PATH", help="restore this checkpoint before simulating")
+    parser.add_argument("--generations", type=int, default=None, help="stop after this many generations in total")
+    parser.add_argument("--checkpoint", metavar="PATH", help="save a checkpoint here when done")
+    parser.add_argument("--shards", type=int, default=None, help="simulate in this many worker processes")
+    parser.add_argument("--database", metavar="URL", default=os.environ.get("SIMULATION_DATABASE_URL"),
+                        help="simulate in this database, e.g. sqlite:///rogers.sqlite or sqlite:// for memory")
+    parser.add_argument("--coalesce", action="store_true", help="write each participant in a single transaction")
+    args = parser.parse_args()
+
+    if args.database:
+        use_database(args.database)
+
+    if args.shards:
+        session = simulate_parallel(args.seed, shards=args.shards, generations=args.generations, coalesce=args.coalesce)
+    elif args.resume:
+        session = load_checkpoint(args.resume)
+    else:
+        session = reset_database()
+    exp = RogersExperiment2b(session, seed=None if args.resume or args.shards else args.seed)
+    exp.verbose = False
+
+    participants = None
+    if args.generations is not None:
+        participants = max(0, args.generations*exp.generation_size - completed_participants())
+    done = simulate(exp, participants=participants, coalesce=args.coalesce)
+    print("{} participants have completed the experiment.".format(done))
+
+    if args.checkpoint:
+        save_checkpoint(args.checkpoint)
+        print("Checkpoint saved to {}".format(args.checkpoint))
@@ -39,6 +39,8 @@ var instructionPages = [ // add as a list as many pages as you like
 
 var num_practice_trials = 5;
 
+var dot_layout;
+
 
 /********************
 * HTML manipulation
@@ -81,6 +83,7 @@ var StroopExperiment = function() {
     createAgent = function() {
 
         ensureSameWorker();
+        dot_layout = undefined;
 
         reqwest({
             url: "/node/" + uniqueId,
@@ -152,6 +155,7 @@ var StroopExperiment = function() {
             success: function (resp) {
                 if (resp.info.type == "state") {
                     state = resp.info.contents;
+                    dot_layout = resp.layout;
                 } else {
                     meme = resp.info.contents;
                 }
@@ -177,6 +181,7 @@ var StroopExperiment = function() {
             success: function (resp) {
                 if (resp.info.type == "state") {
                     state = resp.info.contents;
+                    dot_layout = resp.layout;
                 } else {
                     meme = resp.info.contents;
                 }
@@ -297,6 +302,18 @@ var StroopExperiment = function() {
         colors = [];
         colorsRGB = ["#428bca", "#FBB829"];
 
+        // Each dot in the layout is four numbers: x, y, radius and color.
+        if (dot_layout !== undefined) {
+            for (var j = 0; j < dot_layout.length; j += 4) {
+                var laid_dot = paper.circle(dot_layout[j], dot_layout[j + 1], dot_layout[j + 2]);
+                laid_dot.hide();
+                laid_dot.attr("fill", colorsRGB[dot_layout[j + 3]]);
+                laid_dot.attr("stroke", "#fff");
+                dots.push(laid_dot);
+            }
+            return;
+        }
+
         for (var i = blueDots - 1; i >= 0; i--) {
             colors.push(0);
         }
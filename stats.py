@@ -0,0 +1,54 @@
+"""Running totals of each generation, kept up to date as answers come in."""
+
+from wallace import db
+from sqlalchemy import Integer, String, Column, func
+
+
+class GenerationStats(db.Base):
+    """The number of answers, and of right answers, of one kind of learner in a generation."""
+
+    __tablename__ = "rogers_generation_stats"
+
+    id = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False, index=True)
+    kind = Column(String(50), nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    correct = Column(Integer, nullable=False, default=0)
+
+
+# asocial learners, the three kinds of social source, and environments, whose
+# count is the number that flipped at the end of the generation
+generation_stats_kinds = ["asocial", "single_agent", "single_generation", "triple_generation", "environment"]
+
+
+def count_generation_stats(session, generation, kind, count=1, correct=0):
+    """Add to the running totals of a generation in the current transaction."""
+    table = GenerationStats.__table__
+    updated = session.execute(
+        table.update()
+             .where(table.c.generation == generation)
+             .where(table.c.kind == kind)
+             .values(count=table.c.count + count, correct=table.c.correct + correct))
+    if updated.rowcount == 0:
+        session.execute(table.insert().values(
+            generation=generation, kind=kind, count=count, correct=correct))
+
+
+def generation_stats(session):
+    """The learners, accuracy and environment flips of every generation, for the dashboard."""
+    rows = session.query(GenerationStats.generation, GenerationStats.kind,
+                         func.sum(GenerationStats.count), func.sum(GenerationStats.correct))\
+                  .group_by(GenerationStats.generation, GenerationStats.kind)\
+                  .order_by(GenerationStats.generation)\
+                  .all()
+    generations = []
+    for generation, kind, count, correct in rows:
+        if not generations or generations[-1]["generation"] != generation:
+            generations.append({"generation": generation, "asocial": 0, "social": 0, "accuracy": {}, "flips": 0})
+        stats = generations[-1]
+        if kind == "environment":
+            stats["flips"] += count
+        else:
+            stats["asocial" if kind == "asocial" else "social"] += count
+            stats["accuracy"][kind] = float(correct)/count if count else None
+    return generations
@@ -0,0 +1,47 @@
+"""Group the commits of a block of work into one transaction."""
+
+from sqlalchemy.orm import scoped_session
+from contextlib import contextmanager
+from functools import wraps
+
+
+# Inside a unit of work session.commit() flushes and expires loaded objects,
+# so writes get their ids and later reads are fresh, but nothing is committed
+# until the outermost block ends. Other connections see none of the writes,
+# and any locks taken are held, until then.
+@contextmanager
+def unit_of_work(session):
+    """Commit every commit made on session in the block once, at the end."""
+    if isinstance(session, scoped_session):
+        session = session()
+    depth = session.info.get("unit_of_work", 0)
+    session.info["unit_of_work"] = depth + 1
+    if depth == 0:
+        def commit():
+            session.flush()
+            if session.expire_on_commit:
+                session.expire_all()
+        session.commit = commit
+    try:
+        yield session
+    except Exception:
+        if depth == 0:
+            del session.commit
+            session.rollback()
+        raise
+    finally:
+        session.info["unit_of_work"] = depth
+    if depth == 0:
+        del session.commit
+        session.commit()
+
+
+def coalesced(hook):
+    """Run an experiment hook as one unit of work, if the experiment coalesces commits."""
+    @wraps(hook)
+    def coalesced_hook(self, *args, **kwargs):
+        if not self.coalesce_commits:
+            return hook(self, *args, **kwargs)
+        with unit_of_work(self.session):
+            return hook(self, *args, **kwargs)
+    return coalesced_hook
@@ -0,0 +1,169 @@
+"""Check the structure of every network in a run."""
+
+from __future__ import print_function
+from wallace import db
+from wallace.models import Node, Info
+from wallace.nodes import Agent, Source, Environment
+from wallace.information import Gene, Meme
+from experiment import RogersAgent, RogersAgentFounder, RogersSource, RogersEnvironment, LearningGene
+from archive import with_archive
+from sqlalchemy.sql.expression import select
+from collections import defaultdict
+
+
+def polymorphic_classes(base):
+    """Map the type column of a table to the classes stored in it."""
+    return dict((identity, mapper.class_)
+                for identity, mapper in base.__mapper__.polymorphic_map.items())
+
+
+def load(name, *columns):
+    """Load some columns of every row of a table that has not failed.
+
+    Archived rows are included, so finished networks are checked too.
+    """
+    table = with_archive(name)
+    query = select([table.c[column] for column in columns])
+    if "failed" in table.c:
+        query = query.where(table.c.failed.is_(False))
+    return db.session.execute(query).fetchall()
+
+
+def check_networks(finished=True):
+    """Check every network for the invariants of a Rogers run.
+
+    If finished is false the run may have been stopped early, so networks
+    may have fewer agents than their max_size. Each table is loaded once
+    and grouped by origin, destination and network, so the checks take time
+    linear in the size of the run. Returns a list of problems, which is
+    empty if every network is sound.
+    """
+    node_classes = polymorphic_classes(Node)
+    info_classes = polymorphic_classes(Info)
+    problems = []
+
+    network_table = db.Base.metadata.tables["network"]
+    networks = db.session.execute(select([
+        network_table.c.id, network_table.c.role, network_table.c.max_size])).fetchall()
+    nodes = load("node", "id", "type", "network_id", "property2", "property3", "property4", "property5", "fitness")
+    vectors = load("vector", "origin_id", "destination_id", "network_id")
+    infos = load("info", "id", "type", "origin_id", "contents")
+    transmissions = load("transmission", "info_id", "destination_id", "status")
+
+    node_class = dict((n.id, node_classes[n.type]) for n in nodes)
+    generation = dict((n.id, int(n.property2)) for n in nodes if issubclass(node_class[n.id], Agent))
+    info_class = dict((i.id, info_classes[i.type]) for i in infos)
+
+    nodes_by_network = defaultdict(list)
+    for n in nodes:
+        nodes_by_network[n.network_id].append(n)
+    vectors_by_network = defaultdict(list)
+    vectors_by_destination = defaultdict(list)
+    for v in vectors:
+        vectors_by_network[v.network_id].append(v)
+        vectors_by_destination[v.destination_id].append(v)
+    infos_by_origin = defaultdict(list)
+    for i in infos:
+        infos_by_origin[i.origin_id].append(i)
+    transmissions_by_destination = defaultdict(list)
+    for t in transmissions:
+        transmissions_by_destination[t.destination_id].append(t)
+
+    e = 2
+    b = 1
+    c = 0.3*b
+    baseline = c+0.0001
+
+    for network in networks:
+
+        def problem(text):
+            problems.append("Network {}: {}".format(network.id, text))
+
+        members = nodes_by_network[network.id]
+        agents = [n for n in members if issubclass(node_class[n.id], Agent)]
+        sources = [n for n in members if issubclass(node_class[n.id], Source)]
+        environments = [n for n in members if issubclass(node_class[n.id], Environment)]
+
+        # nodes
+        if len(agents) > network.max_size or (finished and len(agents) != network.max_size):
+            problem("has {} agents, not {}".format(len(agents), network.max_size))
+        if sorted([node_class[s.id].__name__ for s in sources]) != ["RogersSocialSource", "RogersSource"]:
+            problem("has sources {}".format([node_class[s.id].__name__ for s in sources]))
+        if [node_class[env.id] for env in environments] != [RogersEnvironment]:
+            problem("has environments {}".format([node_class[env.id].__name__ for env in environments]))
+        source_ids = [s.id for s in sources if node_class[s.id] == RogersSource]
+        environment_ids = [env.id for env in environments]
+
+        for agent in agents:
+            if network.role in ["practice", "catch"] or generation[agent.id] in [0, 1, 2]:
+                expected = RogersAgentFounder
+            else:
+                expected = RogersAgent
+            if node_class[agent.id] != expected:
+                problem("agent {} in generation {} is a {}".format(agent.id, generation[agent.id], node_class[agent.id].__name__))
+
+            origins = [v.origin_id for v in vectors_by_destination[agent.id]]
+            from_source = len([o for o in origins if o in source_ids])
+            from_environment = len([o for o in origins if o in environment_ids])
+            from_agents = [o for o in origins if issubclass(node_class[o], Agent)]
+            if generation[agent.id] == 0:
+                if len(origins) != 2 or from_source != 1:
+                    problem("agent {} in generation 0 has {} incoming vectors, {} from the source".format(agent.id, len(origins), from_source))
+            else:
+                if len(origins) not in [2, 3] or from_source != 0 or not from_agents:
+                    problem("agent {} has {} incoming vectors, {} from the source and {} from agents".format(agent.id, len(origins), from_source, len(from_agents)))
+            if from_environment != 1:
+                problem("agent {} has {} vectors from the environment".format(agent.id, from_environment))
+
+            # infos
+            own_infos = infos_by_origin[agent.id]
+            genes = [i for i in own_infos if issubclass(info_class[i.id], Gene)]
+            memes = [i for i in own_infos if issubclass(info_class[i.id], Meme)]
+            if len(own_infos) != 2 or len(genes) != 1 or len(memes) != 1 or info_class[genes[0].id] != LearningGene:
+                problem("agent {} made infos {}".format(agent.id, [info_class[i.id].__name__ for i in own_infos]))
+                continue
+            is_asocial = genes[0].contents == "asocial"
+
+            # transmissions: every agent is sent a gene and the state of the
+            # environment, social learners are sent a meme as well
+            in_ts = transmissions_by_destination[agent.id]
+            types = sorted(info_class[t.info_id].__name__ for t in in_ts)
+            if [t for t in in_ts if t.status == "pending"]:
+                problem("agent {} has pending transmissions".format(agent.id))
+            if is_asocial and types != ["LearningGene", "State"]:
+                problem("asocial agent {} was sent {}".format(agent.id, types))
+            if not is_asocial and types != ["LearningGene", "Meme", "State"]:
+                problem("social agent {} was sent {}".format(agent.id, types))
+
+            # fitness
+            score = int(agent.property3)
+            proportion = float(agent.property4)
+            saw_the_dots = int(agent.property5)
+            if score != int((memes[0].contents == "blue") is (proportion > 0.5)):
+                problem("agent {} answered {} at proportion {} but scored {}".format(agent.id, memes[0].contents, proportion, score))
+            if is_asocial:
+                fitness = (baseline + score * b - c) ** e
+            else:
+                fitness = (baseline + score * b - c * saw_the_dots) ** e
+            if agent.fitness != fitness:
+                problem("agent {} has fitness {}, not {}".format(agent.id, agent.fitness, fitness))
+
+        # vectors
+        for v in vectors_by_network[network.id]:
+            origin = node_class[v.origin_id]
+            if issubclass(origin, Agent):
+                if generation[v.origin_id] != generation[v.destination_id] - 1:
+                    problem("vector from agent {} to agent {} skips a generation".format(v.origin_id, v.destination_id))
+            elif not issubclass(origin, (Source, Environment)):
+                problem("vector from node {}, a {}".format(v.origin_id, origin.__name__))
+            if origin == RogersSource and node_class[v.destination_id] != RogersAgentFounder:
+                problem("source sends to node {}, a {}".format(v.destination_id, node_class[v.destination_id].__name__))
+
+    return problems
+
+
+if __name__ == "__main__":
+    problems = check_networks()
+    for p in problems:
+        print(p)
+    print("{} problems found.".format(len(problems)))